@@ -93,6 +93,34 @@ try:
         );
         """)
 
+    # Миграция: raw_json в буфере ДТП храним как JSONB,
+    # чтобы Postgres разбирал JSON один раз при загрузке
+    cursor.execute("""
+        DO $$
+        BEGIN
+            IF EXISTS (
+                SELECT 1 FROM information_schema.columns
+                WHERE table_schema = 'lbn' AND table_name = 'dtp_buffer'
+                  AND column_name = 'raw_json' AND data_type <> 'jsonb'
+            ) THEN
+                ALTER TABLE lbn.dtp_buffer
+                    ALTER COLUMN raw_json TYPE jsonb USING raw_json::jsonb;
+            END IF;
+        END $$;
+    """)
+
+    # Частичный индекс для быстрой выборки необработанных записей буфера
+    cursor.execute("""
+        DO $$
+        BEGIN
+            IF to_regclass('lbn.dtp_buffer') IS NOT NULL THEN
+                CREATE INDEX IF NOT EXISTS dtp_buffer_pending_idx
+                    ON lbn.dtp_buffer (id)
+                    WHERE date_processing IS NULL AND is_error = FALSE;
+            END IF;
+        END $$;
+    """)
+
     connection.commit()
     cursor.close()
     connection.close()
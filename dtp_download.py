@@ -1,8 +1,18 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
+import orjson
+import ijson
+import io
+import threading
+from collections import deque
 import psycopg2
+from psycopg2.extras import execute_values
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import time
+import random
 import logging
 import argparse
 from dotenv import load_dotenv
@@ -10,26 +20,70 @@ import os
 
 # Настройка логов
 logging.basicConfig(
-    level=logging.DEBUG,
+    level=logging.INFO,
     format='%(asctime)s - %(levelname)s - %(message)s',
     handlers=[
         logging.StreamHandler(),
-        logging.FileHandler('dtp_loader.log')
+        logging.FileHandler('dtp_loader.log', delay=True)
     ]
 )
 logger = logging.getLogger()
 
-# Загрузка настроек
-load_dotenv()
-
-# Параметры подключения
-DB_PARAMS = {
-    "dbname": os.getenv("dbname"),
-    "user": os.getenv("user"),
-    "password": os.getenv("password"),
-    "host": os.getenv("host"),
-    "port": os.getenv("port")
-}
+# Параметры подключения: читаем .env один раз при первом обращении,
+# а не при каждом импорте модуля
+_DB_PARAMS = None
+
+def get_db_params():
+    global _DB_PARAMS
+    if _DB_PARAMS is None:
+        load_dotenv()
+        _DB_PARAMS = {
+            "dbname": os.getenv("dbname"),
+            "user": os.getenv("user"),
+            "password": os.getenv("password"),
+            "host": os.getenv("host"),
+            "port": os.getenv("port"),
+            # TCP keepalive, чтобы простаивающее соединение не рвалось
+            "keepalives": 1,
+            "keepalives_idle": 30,
+            "keepalives_interval": 10,
+            "keepalives_count": 5,
+            "application_name": "dtp_download"
+        }
+    return _DB_PARAMS
+
+# Общая сессия с пулом соединений, чтобы не открывать
+# новое TCP-соединение на каждый запрос
+SESSION = requests.Session()
+SESSION.mount("http://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=8,
+    max_retries=Retry(total=3, backoff_factor=1)
+))
+SESSION.headers.update({
+    "User-Agent": "Mozilla/5.0",
+    "Content-Type": "application/json"
+})
+
+# Количество параллельных запросов к API
+MAX_WORKERS = 4
+
+# Минимальный интервал между запросами к API (сек),
+# чтобы не перегружать сервер
+REQUEST_INTERVAL = 1.0
+
+_throttle_lock = threading.Lock()
+_last_request_at = 0.0
+
+def throttle():
+    """Выдерживает паузу между запросами к API (общую для всех потоков)"""
+    global _last_request_at
+    with _throttle_lock:
+        now = time.monotonic()
+        wait = _last_request_at + REQUEST_INTERVAL - now
+        if wait > 0:
+            time.sleep(wait)
+        _last_request_at = time.monotonic()
 
 # Список городов
 CITIES = [
@@ -37,6 +91,25 @@ CITIES = [
     {"name": "Калининград", "region_id": "27", "district_id": "27401"}
 ]
 
+def build_payload_template(city):
+    """Шаблон payload для города: сериализуем JSON один раз,
+    месяц и год подставляются потом через %-форматирование
+    (других символов % в шаблоне нет)
+    """
+    return json.dumps({
+        "date": ["MONTHS:%d.%d"],
+        "ParReg": city["region_id"],
+        "order": {"type": "1", "fieldName": "dat"},
+        "reg": city["district_id"],
+        "ind": "1",
+        "st": "1",
+        "en": "1000",
+        "fil": {"isSummary": False},
+        "fieldNames": ["dat", "time", "coordinates", "infoDtp"]
+    }, separators=(',', ':'))
+
+PAYLOAD_TEMPLATES = {city["name"]: build_payload_template(city) for city in CITIES}
+
 def parse_args():
     parser = argparse.ArgumentParser(description="Загрузка данных о ДТП за указанный период.")
     parser.add_argument("--start_year", type=int, help="Начальный год")
@@ -66,59 +139,184 @@ def get_date_range(args):
 
 def fetch_data_from_api(payload):
     logger.info("Отправляем запрос к API...")
-    headers = {"User-Agent": "Mozilla/5.0", "Content-Type": "application/json"}
-    response = requests.post(
+    response = SESSION.post(
         "http://stat.gibdd.ru/map/getDTPCardData",
         json=payload,
-        headers=headers,
         timeout=45
     )
     response.raise_for_status()
     logger.info("Запрос к API выполнен успешно.")
     return response.json()
 
-def insert_single_record(record, index):
+INSERT_SQL = """
+    INSERT INTO lbn.dtp_BUFFER
+    (city_name, region_id, district_id, raw_json)
+    VALUES %s
+"""
+
+COPY_SQL = """
+    COPY lbn.dtp_BUFFER (city_name, region_id, district_id, raw_json)
+    FROM STDIN WITH (FORMAT text)
+"""
+
+PAGE_SIZE = 1000
+
+def escape_copy(value):
+    """Экранирует значение по правилам текстового формата COPY.
+
+    Работает с bytes, чтобы не гонять сериализованный JSON
+    через лишнее преобразование bytes -> str -> bytes.
+    """
+    if not isinstance(value, bytes):
+        value = str(value).encode()
+    return (
+        value
+        .replace(b'\\', b'\\\\')
+        .replace(b'\t', b'\\t')
+        .replace(b'\n', b'\\n')
+        .replace(b'\r', b'\\r')
+    )
+
+def build_copy_buffer(records):
+    """Собирает записи в байтовый буфер для COPY FROM STDIN"""
+    buf = io.BytesIO()
+    for r in records:
+        buf.write(escape_copy(r["city_name"]))
+        buf.write(b'\t')
+        buf.write(escape_copy(r["region_id"]))
+        buf.write(b'\t')
+        buf.write(escape_copy(r["district_id"]))
+        buf.write(b'\t')
+        buf.write(escape_copy(r["raw_json"]))
+        buf.write(b'\n')
+    buf.seek(0)
+    return buf
+
+def insert_with_execute_values(conn, records):
+    """Запасной путь вставки: execute_values постранично.
+
+    Возвращает список записей, которые вставить не удалось
+    (с точностью до страницы PAGE_SIZE).
+    """
+    # raw_json хранится как bytes для COPY; для параметров
+    # запроса декодируем обратно в текст
+    rows = [
+        (r["city_name"], r["region_id"], r["district_id"], r["raw_json"].decode())
+        for r in records
+    ]
+
+    failed = []
+    with conn.cursor() as cur:
+        # Вставляем постранично, чтобы ошибка затрагивала
+        # только одну страницу, а не весь объём
+        for start in range(0, len(rows), PAGE_SIZE):
+            page = rows[start:start + PAGE_SIZE]
+            try:
+                # raw_json уже сериализован, приводим к jsonb на сервере
+                execute_values(
+                    cur, INSERT_SQL, page,
+                    template="(%s,%s,%s,%s::jsonb)",
+                    page_size=PAGE_SIZE
+                )
+                conn.commit()
+            except psycopg2.Error as e:
+                conn.rollback()
+                logger.error(f"Ошибка вставки страницы {start // PAGE_SIZE + 1}: {e}")
+                failed.extend(records[start:start + PAGE_SIZE])
+    return failed
+
+def insert_records(records):
+    """Загружает записи в dtp_BUFFER через COPY FROM STDIN.
+
+    При ошибке COPY откатывается и повторяет вставку через
+    execute_values. Возвращает список невставленных записей.
+    """
     max_attempts = 5
     for attempt in range(max_attempts):
         conn = None
         try:
-            logger.debug(f"Попытка {attempt + 1} вставки записи {index + 1}")
-
-            # Подключаемся с автокоммитом
-            conn = psycopg2.connect(**DB_PARAMS)
-            conn.autocommit = True  # Включаем автокоммит
-            
-            with conn.cursor() as cur:
-                cur.execute(
-                    """
-                    INSERT INTO lbn.dtp_BUFFER
-                    (city_name, region_id, district_id, raw_json)
-                    VALUES (%s, %s, %s, %s)
-                    """,
-                    (
-                        record["city_name"],
-                        record["region_id"],
-                        record["district_id"],
-                        record["raw_json"]
-                    )
-                )
-            
-            logger.debug(f"Запись {index + 1} успешно вставлена.")
-            return True
-            
+            logger.debug(f"Попытка {attempt + 1} загрузки {len(records)} записей через COPY")
+
+            conn = psycopg2.connect(**get_db_params())
+            conn.autocommit = False
+
+            try:
+                with conn.cursor() as cur:
+                    cur.copy_expert(COPY_SQL, build_copy_buffer(records))
+                conn.commit()
+                logger.debug("COPY завершён.")
+                return []
+            except psycopg2.OperationalError:
+                # Потеря соединения: соединение уже мертво, откатывать
+                # нечего - уходим во внешний retry с новым подключением
+                raise
+            except psycopg2.Error as e:
+                # Ошибка данных/сервера на живом соединении -
+                # повторяем через execute_values
+                conn.rollback()
+                logger.warning(f"COPY не удался ({e}), повторяем через execute_values")
+                return insert_with_execute_values(conn, records)
+
         except psycopg2.OperationalError as e:
-            logger.error(f"Ошибка вставки записи {index + 1} (попытка {attempt + 1}): {e}")
-            time.sleep(2 ** attempt)
-        except Exception as e:
-            logger.error(f"Неожиданная ошибка при вставке записи {index + 1}: {e}")
-            return False
+            logger.error(f"Ошибка соединения (попытка {attempt + 1}): {e}")
+            # Джиттер, чтобы параллельные воркеры не переподключались синхронно
+            time.sleep(min(30, 2 ** attempt) * random.uniform(0.5, 1.5))
         finally:
             # Всегда закрываем соединение
             if conn and not conn.closed:
                 conn.close()
-    
-    logger.error(f"Не удалось вставить запись {index + 1} после {max_attempts} попыток.")
-    return False
+
+    logger.error(f"Не удалось вставить записи после {max_attempts} попыток.")
+    return list(records)
+
+def fetch_month(city, year, month):
+    """Загружает и разбирает данные за один месяц по одному городу.
+
+    Возвращает список записей для вставки в буфер
+    (пустой список при ошибке).
+    """
+    logger.info(f"Загрузка данных за {month}.{year} ({city['name']})...")
+
+    payload = {"data": PAYLOAD_TEMPLATES[city["name"]] % (month, year)}
+
+    records = []
+    try:
+        throttle()
+        response_json = fetch_data_from_api(payload)
+        logger.info("Данные от API получены.")
+
+        if "data" not in response_json:
+            logger.warning("Нет поля 'data' в ответе API")
+            return records
+
+        # Разбираем вложенный JSON потоково, не строя всё дерево в памяти.
+        # use_float=True: иначе ijson отдаёт Decimal,
+        # который orjson.dumps не сериализует
+        try:
+            for record in ijson.items(io.StringIO(response_json["data"]), "tab.item",
+                                      use_float=True):
+                records.append({
+                    "city_name": city["name"],
+                    "region_id": city["region_id"],
+                    "district_id": city["district_id"],
+                    "raw_json": orjson.dumps(record)
+                })
+        except ijson.JSONError as e:
+            logger.warning(f"Невалидный JSON в ответе: {e}")
+            return records
+
+        if not records:
+            logger.info("Нет данных для загрузки")
+            return records
+
+        logger.info(f"Получено {len(records)} записей за {month}.{year}")
+
+    except requests.exceptions.RequestException as e:
+        logger.error(f"Ошибка запроса: {e}")
+    except Exception as e:
+        logger.error(f"Неожиданная ошибка: {e}", exc_info=True)
+
+    return records
 
 def main():
     args = parse_args()
@@ -126,94 +324,61 @@ def main():
 
     logger.info(f"Загрузка данных с {start_month}.{start_year} по {end_month}.{end_year}")
 
-    # Список для хранения всех данных
-    all_records = []
-    failed_records = []
-
+    # Задачи: город x месяц
+    tasks = []
     for city in CITIES:
-        logger.info(f"Обработка города: {city['name']}")
-
         for year in range(start_year, end_year + 1):
             start_m = start_month if year == start_year else 1
             end_m = end_month if year == end_year else 12
-
             for month in range(start_m, end_m + 1):
-                logger.info(f"Загрузка данных за {month}.{year}...")
-
-                payload = {
-                    "data": json.dumps({
-                        "date": [f"MONTHS:{month}.{year}"],
-                        "ParReg": city["region_id"],
-                        "order": {"type": "1", "fieldName": "dat"},
-                        "reg": city["district_id"],
-                        "ind": "1",
-                        "st": "1",
-                        "en": "1000",
-                        "fil": {"isSummary": False},
-                        "fieldNames": ["dat", "time", "coordinates", "infoDtp"]
-                    }, separators=(',', ':'))
-                }
-
-                try:
-                    response_json = fetch_data_from_api(payload)
-                    logger.info("Данные от API получены.")
-
-                    if "data" not in response_json:
-                        logger.warning("Нет поля 'data' в ответе API")
-                        continue
-
-                    try:
-                        data = json.loads(response_json["data"]).get("tab", [])
-                    except json.JSONDecodeError as e:
-                        logger.warning(f"Невалидный JSON в ответе: {e}")
-                        continue
-
-                    if not data:
-                        logger.info("Нет данных для загрузки")
-                        continue
-
-                    # Сохраняем данные во временный список
-                    for record in data:
-                        all_records.append({
-                            "city_name": city["name"],
-                            "region_id": city["region_id"],
-                            "district_id": city["district_id"],
-                            "raw_json": json.dumps(record, ensure_ascii=False)
-                        })
-
-                    logger.info(f"Получено {len(data)} записей за {month}.{year}")
-
-                except requests.exceptions.RequestException as e:
-                    logger.error(f"Ошибка запроса: {e}")
-                    continue
-                except Exception as e:
-                    logger.error(f"Неожиданная ошибка: {e}", exc_info=True)
-                    continue
-
-                time.sleep(1)  # Пауза между месяцами
-
-    # Вставляем данные в базу по одной записи
-    if all_records:
-        logger.info(f"Начинаем вставку {len(all_records)} записей в базу данных...")
-        success_count = 0
-        for index, record in enumerate(all_records):
-            logger.info(f"Вставляем запись {index + 1} из {len(all_records)}...")
-            if insert_single_record(record, index):
-                success_count += 1
-            else:
-                failed_records.append(record)
-                logger.warning(f"Не удалось вставить запись {index + 1}.")
-
-        logger.info(f"Успешно вставлено {success_count} записей из {len(all_records)}.")
+                tasks.append((city, year, month))
+
+    # Буфер на одну страницу вставки: память O(PAGE_SIZE),
+    # а не O(всех записей); загрузка идёт параллельно с запросами
+    buffer = deque()
+    failed_records = []
+    total_count = 0
+
+    def flush():
+        records = list(buffer)
+        buffer.clear()
+        if records:
+            logger.info(f"Вставляем {len(records)} записей в базу данных...")
+            failed_records.extend(insert_records(records))
+
+    # Запросы к API сетевые, выполняем их параллельно
+    # через общую сессию
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = {
+            executor.submit(fetch_month, city, year, month): (city["name"], year, month)
+            for city, year, month in tasks
+        }
+        for future in as_completed(futures):
+            records = future.result()
+            total_count += len(records)
+            buffer.extend(records)
+            if len(buffer) >= PAGE_SIZE:
+                flush()
+
+    flush()
+
+    if total_count:
+        success_count = total_count - len(failed_records)
+        logger.info(f"Успешно вставлено {success_count} записей из {total_count}.")
 
         # Сохраняем невставленные записи в файл
         if failed_records:
             logger.warning(f"Не удалось вставить {len(failed_records)} записей. Сохраняем их в failed_records.json...")
             with open('failed_records.json', 'w', encoding='utf-8') as f:
-                json.dump(failed_records, f, ensure_ascii=False)
+                # raw_json хранится как bytes - декодируем для записи в JSON
+                json.dump(
+                    [dict(r, raw_json=r["raw_json"].decode()) for r in failed_records],
+                    f, ensure_ascii=False
+                )
     else:
         logger.info("Нет данных для вставки в базу.")
 
+    SESSION.close()
     logger.info("Работа скрипта завершена")
 
 if __name__ == "__main__":
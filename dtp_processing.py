@@ -1,56 +1,95 @@
-import json
-import psycopg2
-from psycopg2 import pool
-from datetime import datetime
+import orjson
+from psycopg_pool import ConnectionPool
+from datetime import datetime, date, time as dt_time
+import re
 from dotenv import load_dotenv
 import os
 import logging
 import sys
 import time
+import random
 
 # Настройка логирования
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(levelname)s - %(message)s',
     handlers=[
-        logging.FileHandler('dtp_processing.log', mode='a'),
+        logging.FileHandler('dtp_processing.log', mode='a', delay=True),
         logging.StreamHandler(sys.stdout)
     ]
 )
 logger = logging.getLogger(__name__)
 
-# Загрузка настроек
-load_dotenv()
-DB_CONFIG = {
-    "dbname": os.getenv("dbname"),
-    "user": os.getenv("user"),
-    "password": os.getenv("password"),
-    "host": os.getenv("host"),
-    "port": os.getenv("port")
-}
+# Параметры подключения: читаем .env один раз при первом обращении,
+# а не при каждом импорте модуля
+_DB_CONFIG = None
+
+def get_db_config():
+    global _DB_CONFIG
+    if _DB_CONFIG is None:
+        load_dotenv()
+        _DB_CONFIG = {
+            "dbname": os.getenv("dbname"),
+            "user": os.getenv("user"),
+            "password": os.getenv("password"),
+            "host": os.getenv("host"),
+            "port": os.getenv("port"),
+            # TCP keepalive, чтобы простаивающие соединения пула не рвались
+            "keepalives": 1,
+            "keepalives_idle": 30,
+            "keepalives_interval": 10,
+            "keepalives_count": 5,
+            "application_name": "dtp_processing"
+        }
+    return _DB_CONFIG
+
+# Предкомпилированные шаблоны вместо strptime и try/except:
+# проверка регуляркой дешевле, чем исключение на каждый вызов
+_DATE_RE = re.compile(r'^(\d{2})\.(\d{2})\.(\d{4})$')
+_TIME_RE = re.compile(r'^(\d{1,2}):(\d{2})$')
 
 def parse_date(date_str):
+    if not date_str:
+        return None
+    m = _DATE_RE.match(date_str)
+    if not m:
+        return None
     try:
-        return datetime.strptime(date_str, '%d.%m.%Y').date() if date_str else None
-    except:
+        return date(int(m[3]), int(m[2]), int(m[1]))
+    except ValueError:
+        # Несуществующая дата вроде 31.02
         return None
 
 def parse_time(time_str):
-    try:
-        return datetime.strptime(time_str, '%H:%M').time() if time_str else None
-    except:
+    if not time_str:
+        return None
+    m = _TIME_RE.match(time_str)
+    if not m:
         return None
+    hour, minute = int(m[1]), int(m[2])
+    if hour > 23 or minute > 59:
+        return None
+    return dt_time(hour, minute)
 
 def parse_int(value):
+    if isinstance(value, int):
+        # int(...) нормализует и bool
+        return int(value)
+    if value is None:
+        return 0
     try:
-        return int(value) if value is not None else 0
-    except:
+        return int(value)
+    except (TypeError, ValueError):
         return 0
 
 def parse_float(value):
+    if isinstance(value, (int, float)):
+        return float(value)
+    if value is None:
+        return 0.0
     try:
-        return float(str(value).replace(',', '.')) if value is not None else 0.0
-    except:
+        return float(str(value).replace(',', '.'))
+    except (TypeError, ValueError):
         return 0.0
 
 def safe_join(value):
@@ -62,20 +101,224 @@ def safe_join(value):
             return str(value)
     return str(value) if value is not None else ''
 
+# Построчная вставка в dtp_main (28 колонок); план кэшируется
+# на сервере через prepare=True / executemany
+INSERT_MAIN_SQL = """
+    INSERT INTO lbn.dtp_main (
+        kart_id, region_id, district_id, row_num, dtp_date, dtp_time, district,
+        dtp_type, deaths, wounded, vehicles_count, participants_count, emtp_number,
+        settlement, street, house, road, km, m, road_category, road_class,
+        road_quality, weather, road_condition, lighting, dtp_severity, coord_w, coord_l
+    ) VALUES ({})
+    ON CONFLICT (kart_id) DO NOTHING
+""".format(", ".join(["%s"] * 28))
+
+# Основной путь: разбор JSONB и вставка в dtp_main целиком на сервере,
+# без передачи raw_json клиенту и без разбора в Python
+INSERT_FROM_BUFFER_SQL = """
+    INSERT INTO lbn.dtp_main (
+        kart_id, region_id, district_id, row_num, dtp_date, dtp_time, district,
+        dtp_type, deaths, wounded, vehicles_count, participants_count, emtp_number,
+        settlement, street, house, road, km, m, road_category, road_class,
+        road_quality, weather, road_condition, lighting, dtp_severity, coord_w, coord_l
+    )
+    SELECT
+        r->>'KartId',
+        b.region_id,
+        b.district_id,
+        COALESCE((r->>'rowNum')::int, 0),
+        to_date(r->>'date', 'DD.MM.YYYY'),
+        (r->>'Time')::time,
+        COALESCE(r->>'District', ''),
+        COALESCE(r->>'DTP_V', ''),
+        COALESCE((r->>'POG')::int, 0),
+        COALESCE((r->>'RAN')::int, 0),
+        COALESCE((r->>'K_TS')::int, 0),
+        COALESCE((r->>'K_UCH')::int, 0),
+        COALESCE(r->>'emtp_number', ''),
+        COALESCE(r#>>'{infoDtp,n_p}', b.city_name, 'Не указан'),
+        COALESCE(r#>>'{infoDtp,street}', ''),
+        COALESCE(r#>>'{infoDtp,house}', ''),
+        COALESCE(r#>>'{infoDtp,dor}', ''),
+        COALESCE(r#>>'{infoDtp,km}', ''),
+        COALESCE(r#>>'{infoDtp,m}', ''),
+        COALESCE(r#>>'{infoDtp,k_ul}', ''),
+        COALESCE(r#>>'{infoDtp,dor_z}', ''),
+        COALESCE(r#>>'{infoDtp,s_pch}', ''),
+        COALESCE(r#>>'{infoDtp,osv}', ''),
+        COALESCE(r#>>'{infoDtp,sdor}', ''),
+        COALESCE(r#>>'{infoDtp,change_org_motion}', ''),
+        COALESCE(r#>>'{infoDtp,s_dtp}', ''),
+        COALESCE(replace(r#>>'{infoDtp,COORD_W}', ',', '.')::float, 0.0),
+        COALESCE(replace(r#>>'{infoDtp,COORD_L}', ',', '.')::float, 0.0)
+    FROM lbn.dtp_buffer b,
+         jsonb_array_elements(
+             CASE WHEN jsonb_typeof(b.raw_json) = 'array'
+                  THEN b.raw_json
+                  ELSE jsonb_build_array(b.raw_json) END
+         ) AS r
+    WHERE b.id = ANY(%s)
+      AND r->>'KartId' IS NOT NULL
+      AND r->>'KartId' <> ''
+    ON CONFLICT (kart_id) DO NOTHING
+"""
+
+def build_main_rows(record_id, region_id, district_id, raw_json, city_name):
+    """Разбирает raw_json одной записи буфера в кортежи для dtp_main"""
+    # Колонка raw_json типа JSONB приходит из psycopg уже
+    # разобранной (dict/list); текст остаётся для старых записей
+    if isinstance(raw_json, (str, bytes)):
+        raw_json = orjson.loads(raw_json)
+    if isinstance(raw_json, dict):
+        data_list = [raw_json]
+    elif isinstance(raw_json, list):
+        data_list = raw_json
+    else:
+        raise ValueError("Некорректный формат JSON")
+
+    rows = []
+    # Локальные ссылки: LOAD_FAST заметно дешевле LOAD_GLOBAL
+    # и повторного поиска связанных методов в горячем цикле
+    pi = parse_int
+    pf = parse_float
+    pd = parse_date
+    pt = parse_time
+    append = rows.append
+    for data in data_list:
+        if not isinstance(data, dict):
+            logger.debug(f"ID {record_id}: Пропуск - не dict")
+            continue
+
+        d = data.get
+        kart_id = d('KartId')
+        if not kart_id:
+            logger.debug(f"ID {record_id}: Пропуск - нет KartId")
+            continue
+
+        info = d('infoDtp', {})
+        g = info.get
+        settlement = g('n_p', city_name)
+
+        append((
+            kart_id, region_id, district_id, pi(d('rowNum')),
+            pd(d('date')), pt(d('Time')),
+            d('District', ''), d('DTP_V', ''), pi(d('POG', 0)),
+            pi(d('RAN', 0)), pi(d('K_TS', 0)),
+            pi(d('K_UCH', 0)), d('emtp_number', ''), settlement,
+            g('street', ''), g('house', ''), g('dor', ''),
+            g('km', ''), g('m', ''), g('k_ul', ''),
+            g('dor_z', ''), g('s_pch', ''), g('osv', ''),
+            g('sdor', ''), g('change_org_motion', ''),
+            g('s_dtp', ''), pf(g('COORD_W', 0.0)),
+            pf(g('COORD_L', 0.0))
+        ))
+    return rows
+
+def process_rows_individually(conn, cur, parsed):
+    """Запасной путь: вставка по одной записи с SAVEPOINT,
+    чтобы ошибка одной записи не откатывала весь батч.
+
+    Возвращает (ok_ids, bad_ids).
+    """
+    ok_ids = []
+    bad_ids = []
+    # Pipeline: команды уходят на сервер без ожидания ответа каждой,
+    # ошибки записи всплывают на sync() и откатываются к SAVEPOINT
+    with conn.pipeline() as pipeline:
+        for record_id, main_rows in parsed:
+            cur.execute("SAVEPOINT record_sp")
+            try:
+                for row in main_rows:
+                    # Дубликаты обрабатывает ON CONFLICT DO NOTHING;
+                    # prepare=True кэширует план оператора на сервере
+                    cur.execute(INSERT_MAIN_SQL, row, prepare=True)
+                cur.execute("RELEASE SAVEPOINT record_sp")
+                pipeline.sync()
+                ok_ids.append(record_id)
+            except Exception as e:
+                logger.error(f"✗ ID {record_id}: Ошибка: {e}")
+                cur.execute("ROLLBACK TO SAVEPOINT record_sp")
+                pipeline.sync()
+                bad_ids.append(record_id)
+    return ok_ids, bad_ids
+
+def process_batch_python(batch_conn, cur, ids):
+    """Запасной путь: выбираем raw_json на клиента и разбираем в Python.
+
+    Возвращает (ok_ids, bad_ids).
+    """
+    cur.execute("""
+        SELECT id, region_id, district_id, raw_json, city_name
+        FROM lbn.dtp_buffer
+        WHERE id = ANY(%s)
+        ORDER BY id
+    """, (ids,))
+    rows = cur.fetchall()
+
+    # Фаза разбора: собираем кортежи всего батча
+    parsed = []   # (id записи буфера, кортежи для dtp_main)
+    bad_ids = []  # записи с ошибкой разбора
+    for row in rows:
+        id, region_id, district_id, raw_json, city_name = row
+        city_name = city_name if city_name else "Не указан"
+        try:
+            parsed.append((id, build_main_rows(
+                id, region_id, district_id, raw_json, city_name
+            )))
+        except Exception as e:
+            logger.error(f"ID {id}: Ошибка парсинга JSON: {e}")
+            bad_ids.append(id)
+
+    main_rows = [r for _, record_rows in parsed for r in record_rows]
+    ok_ids = [record_id for record_id, _ in parsed]
+
+    # SAVEPOINT по той же причине, что и в main: блокировки
+    # FOR UPDATE должны пережить переход на построчный путь
+    cur.execute("SAVEPOINT python_sp")
+    try:
+        # Один пакетный INSERT на весь батч: executemany в psycopg3
+        # сам группирует команды через pipeline
+        if main_rows:
+            cur.executemany(INSERT_MAIN_SQL, main_rows)
+        cur.execute("RELEASE SAVEPOINT python_sp")
+    except Exception as e:
+        logger.warning(f"Пакетная вставка не удалась ({e}), вставляем по одной записи")
+        cur.execute("ROLLBACK TO SAVEPOINT python_sp")
+        ok_ids, row_bad_ids = process_rows_individually(batch_conn, cur, parsed)
+        bad_ids.extend(row_bad_ids)
+
+    return ok_ids, bad_ids
+
+# Пул соединений вместо нового подключения на каждый вызов
+POOL = None
+
+def get_pool():
+    """Создаёт пул соединений при первом обращении"""
+    global POOL
+    if POOL is None:
+        POOL = ConnectionPool(min_size=1, max_size=8, kwargs=get_db_config())
+    return POOL
+
 def get_connection():
-    """Получаем соединение с повторными попытками"""
+    """Получаем соединение из пула с повторными попытками"""
     max_attempts = 3
     for attempt in range(max_attempts):
         try:
-            conn = psycopg2.connect(**DB_CONFIG)
+            conn = get_pool().getconn()
             conn.autocommit = True
             return conn
         except Exception as e:
             logger.warning(f"Попытка {attempt + 1}: Ошибка подключения: {e}")
             if attempt < max_attempts - 1:
-                time.sleep(2 ** attempt)
+                # Джиттер, чтобы параллельные воркеры не переподключались синхронно
+                time.sleep(min(30, 2 ** attempt) * random.uniform(0.5, 1.5))
     return None
 
+def release_connection(conn):
+    """Возвращаем соединение в пул"""
+    if conn and POOL is not None:
+        POOL.putconn(conn)
+
 def main():
     logger.info("=" * 60)
     logger.info("НАЧАЛО ОБРАБОТКИ ДТП")
@@ -114,11 +357,16 @@ def main():
         # Начинаем обработку
         processed_count = 0
         error_count = 0
-        batch_size = 10  # Малый размер для начала
+        batch_size = 1000
+        # Пауза между батчами не нужна: коммит транзакции сам
+        # служит точкой синхронизации; при желании задаётся через env
+        batch_sleep = float(os.getenv("DTP_BATCH_SLEEP", "0"))
         
         logger.info(f"Начинаем обработку {to_process} записей...")
         
         while True:
+            batch_started = time.monotonic()
+
             # Получаем новое соединение для каждого цикла
             batch_conn = get_connection()
             if not batch_conn:
@@ -126,148 +374,79 @@ def main():
                 break
                 
             try:
+                # Весь батч обрабатываем в одной транзакции
+                batch_conn.autocommit = False
                 with batch_conn.cursor() as cur:
-                    # Получаем записи для обработки
+                    # Забираем id записей для обработки; raw_json
+                    # на клиента не тянем. SKIP LOCKED позволяет
+                    # запускать несколько обработчиков параллельно
                     cur.execute("""
-                        SELECT id, region_id, district_id, raw_json, city_name
+                        SELECT id
                         FROM lbn.dtp_buffer
                         WHERE date_processing IS NULL
                         AND is_error = FALSE
                         ORDER BY id
                         LIMIT %s
+                        FOR UPDATE SKIP LOCKED
                     """, (batch_size,))
-                    
-                    rows = cur.fetchall()
-                    if not rows:
+
+                    ids = [row[0] for row in cur.fetchall()]
+                    if not ids:
                         logger.info("Больше нет записей для обработки")
                         break
-                    
-                    logger.info(f"Найдено {len(rows)} записей для обработки")
-                    
-                    for i, row in enumerate(rows):
-                        id, region_id, district_id, raw_json, city_name = row
-                        city_name = city_name if city_name else "Не указан"
-                        
-                        logger.info(f"[{i+1}/{len(rows)}] Обработка id={id}")
-                        
-                        # Обрабатываем каждую запись в отдельном соединении
-                        record_conn = get_connection()
-                        if not record_conn:
-                            logger.error(f"Не удалось получить соединение для записи id={id}")
-                            continue
-                            
-                        try:
-                            with record_conn.cursor() as record_cur:
-                                # Парсинг JSON
-                                try:
-                                    if isinstance(raw_json, dict):
-                                        data_list = [raw_json]
-                                    else:
-                                        data = json.loads(raw_json)
-                                        if isinstance(data, dict):
-                                            data_list = [data]
-                                        elif isinstance(data, list):
-                                            data_list = data
-                                        else:
-                                            raise ValueError("Некорректный формат JSON")
-                                except Exception as e:
-                                    logger.error(f"ID {id}: Ошибка парсинга JSON: {e}")
-                                    raise
-                                
-                                for data in data_list:
-                                    if not isinstance(data, dict):
-                                        logger.warning(f"ID {id}: Пропуск - не dict")
-                                        continue
-                                    
-                                    kart_id = data.get('KartId')
-                                    if not kart_id:
-                                        logger.warning(f"ID {id}: Пропуск - нет KartId")
-                                        continue
-                                    
-                                    info = data.get('infoDtp', {})
-                                    
-                                    # Обработка dtp_main
-                                    dtp_date = parse_date(data.get('date'))
-                                    dtp_time = parse_time(data.get('Time'))
-                                    settlement = info.get('n_p', city_name)
-                                    
-                                    # Вставляем основную информацию (без удаления старых записей пока)
-                                    try:
-                                        record_cur.execute("""
-                                            INSERT INTO lbn.dtp_main (
-                                                kart_id, region_id, district_id, row_num, dtp_date, dtp_time, district,
-                                                dtp_type, deaths, wounded, vehicles_count, participants_count, emtp_number,
-                                                settlement, street, house, road, km, m, road_category, road_class,
-                                                road_quality, weather, road_condition, lighting, dtp_severity, coord_w, coord_l
-                                            ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s,
-                                                      %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                                        """, (
-                                            kart_id, region_id, district_id, parse_int(data.get('rowNum')), dtp_date, dtp_time,
-                                            data.get('District', ''), data.get('DTP_V', ''), parse_int(data.get('POG', 0)),
-                                            parse_int(data.get('RAN', 0)), parse_int(data.get('K_TS', 0)),
-                                            parse_int(data.get('K_UCH', 0)), data.get('emtp_number', ''), settlement,
-                                            info.get('street', ''), info.get('house', ''), info.get('dor', ''),
-                                            info.get('km', ''), info.get('m', ''), info.get('k_ul', ''),
-                                            info.get('dor_z', ''), info.get('s_pch', ''), info.get('osv', ''),
-                                            info.get('sdor', ''), info.get('change_org_motion', ''),
-                                            info.get('s_dtp', ''), parse_float(info.get('COORD_W', 0.0)),
-                                            parse_float(info.get('COORD_L', 0.0))
-                                        ))
-                                        logger.debug(f"ID {id}: dtp_main вставлен")
-                                        
-                                    except psycopg2.errors.UniqueViolation:
-                                        # Если запись уже существует - обновляем
-                                        logger.debug(f"ID {id}: Запись уже существует, обновляем")
-                                        # Можно добавить UPDATE здесь
-                                        pass
-                                    except Exception as e:
-                                        logger.error(f"ID {id}: Ошибка вставки dtp_main: {e}")
-                                        raise
-                                    
-                                    # Помечаем как обработанную
-                                    record_cur.execute("""
-                                        UPDATE lbn.dtp_buffer
-                                        SET date_processing = CURRENT_TIMESTAMP
-                                        WHERE id = %s
-                                    """, (id,))
-                                    
-                                    processed_count += 1
-                                    logger.info(f"ID {id}: Успешно обработано (всего: {processed_count})")
-                                    
-                        except Exception as e:
-                            error_count += 1
-                            logger.error(f"✗ ID {id}: Ошибка: {e}")
-                            
-                            # Пробуем пометить как ошибку
-                            try:
-                                error_conn = get_connection()
-                                if error_conn:
-                                    with error_conn.cursor() as error_cur:
-                                        error_cur.execute("""
-                                            UPDATE lbn.dtp_buffer
-                                            SET is_error = TRUE
-                                            WHERE id = %s
-                                        """, (id,))
-                                    error_conn.close()
-                            except:
-                                pass
-                                
-                        finally:
-                            if record_conn:
-                                record_conn.close()
-                        
-                        # Пауза между записями
-                        time.sleep(0.5)
-                    
+
+                    logger.debug(f"Найдено {len(ids)} записей для обработки")
+
+                    # Откат к SAVEPOINT, а не всей транзакции: иначе
+                    # пропадут блокировки FOR UPDATE и параллельный
+                    # обработчик заберёт те же записи
+                    cur.execute("SAVEPOINT batch_sp")
+                    try:
+                        # Основной путь: один серверный INSERT ... SELECT,
+                        # JSONB разбирается внутри Postgres
+                        cur.execute(INSERT_FROM_BUFFER_SQL, (ids,))
+                        cur.execute("RELEASE SAVEPOINT batch_sp")
+                        ok_ids, bad_ids = ids, []
+                    except Exception as e:
+                        logger.warning(f"Серверная вставка не удалась ({e}), разбираем в Python")
+                        cur.execute("ROLLBACK TO SAVEPOINT batch_sp")
+                        ok_ids, bad_ids = process_batch_python(batch_conn, cur, ids)
+
+                    # Помечаем обработанные и ошибочные записи одним UPDATE
+                    if ok_ids:
+                        cur.execute("""
+                            UPDATE lbn.dtp_buffer
+                            SET date_processing = CURRENT_TIMESTAMP
+                            WHERE id = ANY(%s)
+                        """, (ok_ids,))
+                    if bad_ids:
+                        cur.execute("""
+                            UPDATE lbn.dtp_buffer
+                            SET is_error = TRUE
+                            WHERE id = ANY(%s)
+                        """, (bad_ids,))
+
+                    processed_count += len(ok_ids)
+                    error_count += len(bad_ids)
+
+                    # Фиксируем весь батч одной транзакцией
+                    batch_conn.commit()
+
+                    # Одна сводная запись в лог на батч вместо записи на строку
+                    logger.info(
+                        "Батч обработан: записей=%d ok=%d ошибок=%d время=%.2fс",
+                        len(ids), len(ok_ids), len(bad_ids),
+                        time.monotonic() - batch_started
+                    )
+
             except Exception as e:
                 logger.error(f"Ошибка в цикле обработки: {e}")
             finally:
                 if batch_conn:
-                    batch_conn.close()
+                    release_connection(batch_conn)
             
-            # Пауза между батчами
-            logger.info(f"Батч обработан. Пауза 2 секунды...")
-            time.sleep(2)
+            if batch_sleep:
+                time.sleep(batch_sleep)
         
         logger.info("=" * 60)
         logger.info(f"ОБРАБОТКА ЗАВЕРШЕНА:")
@@ -280,8 +459,10 @@ def main():
         logger.error(f"КРИТИЧЕСКАЯ ОШИБКА: {e}", exc_info=True)
     finally:
         if conn:
-            conn.close()
-            logger.info("Соединение закрыто")
+            release_connection(conn)
+        if POOL is not None:
+            POOL.close()
+            logger.info("Пул соединений закрыт")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file